@@ -1,13 +1,259 @@
 from flask import Flask, render_template, request
-import csv
-from scipy.stats import ttest_ind
+from collections import OrderedDict
+from hashlib import blake2b
+import threading
+from typing import NamedTuple
+from markupsafe import escape
+import numpy as np
+import pandas as pd
+from scipy.special import stdtr
 import logging
 
+# pyarrow's multithreaded CSV reader is used when it is installed
+try:
+    import pyarrow
+    import pyarrow.csv as pyarrow_csv
+except ImportError:
+    pyarrow_csv = None
+
 app = Flask(__name__)
 
 # Set up logging to console only
 # logging.basicConfig(level=logging.DEBUG, format='%(name)s - %(levelname)s - %(message)s')
 
+# Columns of the Ads Manager export; the amount column carries the account currency
+RESULTS_COLUMN = 'Results'
+TIME_COLUMN = 'Time of day (ad account time zone)'
+AMOUNT_COLUMN = 'Amount spent ({currency})'
+
+SIGNIFICANCE_LEVEL = 0.05
+
+# Least recently used hourly totals of uploads, keyed by (upload digest, currency),
+# so identical uploads skip parsing
+HOURLY_TOTALS_CACHE_SIZE = 128
+UPLOAD_HASH_CHUNK_SIZE = 1 << 16
+hourly_totals_cache = OrderedDict()
+hourly_totals_cache_lock = threading.Lock()
+
+# Windows of hours are 24-bit integers with one bit per hour of the day
+ALL_HOURS_BITMASK = (1 << 24) - 1
+HOUR_BITS = 1 << np.arange(24)
+
+def window_bitmask(start_hour, window_size):
+    # Rotate a run of window_size bits left by start_hour, wrapping past midnight
+    run = (1 << window_size) - 1
+    return ((run << start_hour) | (run >> (24 - start_hour))) & ALL_HOURS_BITMASK
+
+# Every candidate window, indexed by (window size - 1, start hour) and marking the hours it covers
+MIN_WINDOW_SIZE = 1
+MAX_WINDOW_SIZE = 23
+WINDOW_MASKS = np.array([
+    [(window_bitmask(start_hour, window_size) & HOUR_BITS) != 0 for start_hour in range(24)]
+    for window_size in range(MIN_WINDOW_SIZE, MAX_WINDOW_SIZE + 1)
+])
+# The same masks as one row per (window size, start hour), ready for a single matrix product
+WINDOW_MATRIX = WINDOW_MASKS.reshape(-1, 24).astype(np.float64)
+
+DEFAULT_MIN_WINDOW_SIZE = 3
+DEFAULT_MAX_WINDOW_SIZE = 12
+
+# Metrics of the worst window found for each window size; worst_start is -1 when
+# no window costs anything per result
+WINDOW_RESULT_DTYPE = np.dtype([
+    ('window_size', np.int64),
+    ('worst_start', np.int64),
+    ('current_avg_cost', np.float64),
+    ('avg_cost_worst_hours', np.float64),
+    ('avg_cost_remaining_hours', np.float64),
+    ('improvement_percentage', np.float64),
+    ('p_value', np.float64),
+])
+
+def ttest_pvalues(values, masks):
+    # Two-sided p-values of Student's t-test (same as scipy.stats.ttest_ind defaults)
+    # comparing values outside against values inside each row of masks
+    n_in = masks.sum(axis=1)
+    n_out = values.size - n_in
+    dof = values.size - 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_in = (masks @ values) / n_in
+        mean_out = (~masks @ values) / n_out
+        squares_in = np.where(masks, values - mean_in[:, None], 0) ** 2
+        squares_out = np.where(masks, 0, values - mean_out[:, None]) ** 2
+        pooled_var = (squares_in.sum(axis=1) + squares_out.sum(axis=1)) / dof
+        t_stat = (mean_out - mean_in) / np.sqrt(pooled_var * (1 / n_in + 1 / n_out))
+    return 2 * stdtr(dof, -np.abs(t_stat))
+
+def search_windows(hourly_spent, hourly_results, min_window_size=DEFAULT_MIN_WINDOW_SIZE, max_window_size=DEFAULT_MAX_WINDOW_SIZE):
+    # Worst consecutive hours and their metrics for every window size, working only
+    # on the 24-element hourly arrays so it can be rerun without the upload
+
+    # Calculate cost per result
+    hourly_cost_per_result = np.divide(hourly_spent, hourly_results, out=np.zeros(24), where=hourly_results != 0)
+
+    # Calculate current average cost per result
+    total_results = hourly_results.sum()
+    total_cost = hourly_spent.sum()
+    current_avg_cost = total_cost / total_results if total_results != 0 else 0
+
+    # Totals of every candidate window in one matrix product, one row per window size
+    window_sizes = np.arange(min_window_size, max_window_size + 1)
+    window_matrix = WINDOW_MATRIX[(min_window_size - MIN_WINDOW_SIZE) * 24:(max_window_size - MIN_WINDOW_SIZE + 1) * 24]
+    window_spent = (window_matrix @ hourly_spent).reshape(len(window_sizes), 24)
+    window_results = (window_matrix @ hourly_results).reshape(len(window_sizes), 24)
+    window_avg_cost = np.divide(window_spent, window_results, out=np.zeros_like(window_spent), where=window_results != 0)
+
+    # Find the worst consecutive hours for each window size
+    rows = np.arange(len(window_sizes))
+    worst_starts = window_avg_cost.argmax(axis=1)
+    avg_cost_worst_hours = window_avg_cost[rows, worst_starts]
+    has_worst_hours = avg_cost_worst_hours > 0
+    worst_masks = WINDOW_MASKS[window_sizes - MIN_WINDOW_SIZE, worst_starts] & has_worst_hours[:, None]
+
+    total_cost_remaining_hours = total_cost - np.where(has_worst_hours, window_spent[rows, worst_starts], 0)
+    total_results_remaining_hours = total_results - np.where(has_worst_hours, window_results[rows, worst_starts], 0)
+    avg_cost_remaining_hours = np.divide(
+        total_cost_remaining_hours, total_results_remaining_hours,
+        out=np.zeros(len(window_sizes)), where=total_results_remaining_hours != 0
+    )
+
+    improvement_percentages = ((current_avg_cost - avg_cost_remaining_hours) / current_avg_cost) * 100 if current_avg_cost != 0 else np.zeros(len(window_sizes))
+    p_values = ttest_pvalues(hourly_cost_per_result, worst_masks)
+
+    results = np.empty(len(window_sizes), dtype=WINDOW_RESULT_DTYPE)
+    results['window_size'] = window_sizes
+    results['worst_start'] = np.where(has_worst_hours, worst_starts, -1)
+    results['current_avg_cost'] = np.round(current_avg_cost, 2)
+    results['avg_cost_worst_hours'] = np.round(avg_cost_worst_hours, 2)
+    results['avg_cost_remaining_hours'] = np.round(avg_cost_remaining_hours, 2)
+    results['improvement_percentage'] = np.round(improvement_percentages, 2)
+    results['p_value'] = np.round(p_values, 4)
+
+    return results
+
+def load_hourly_totals(stream, currency):
+    # Parse an Ads Manager export into 24-element spend and results arrays indexed by hour
+    amount_column = AMOUNT_COLUMN.format(currency=currency)
+    required_columns = [RESULTS_COLUMN, TIME_COLUMN, amount_column]
+
+    # Spend and results are parsed as float32 to halve the bytes the aggregation reads.
+    # This trades precision: float32 keeps about 7 significant digits, so an amount
+    # near 123456.78 can be stored up to about 0.004 off before np.bincount sums it
+    # in float64, and over many rows the 2-decimal figures shown can shift. Ad spend
+    # is far below float32's range, so nothing overflows or clips.
+    if pyarrow_csv is not None:
+        # Same column types and quoting rules as the pandas branch below
+        parse_options = pyarrow_csv.ParseOptions(newlines_in_values=True)
+        convert_options = pyarrow_csv.ConvertOptions(
+            include_columns=required_columns,
+            column_types={TIME_COLUMN: pyarrow.string(), RESULTS_COLUMN: pyarrow.float32(), amount_column: pyarrow.float32()}
+        )
+        try:
+            df = pyarrow_csv.read_csv(stream, parse_options=parse_options, convert_options=convert_options).to_pandas()
+        except KeyError:
+            # A required column is missing; read only the header so it is reported below
+            stream.seek(0)
+            df = pyarrow_csv.open_csv(stream, parse_options=parse_options).schema.empty_table().to_pandas()
+    else:
+        # Let the C parser decode the upload in chunks and keep only the columns we need
+        df = pd.read_csv(
+            stream, encoding='utf-8', usecols=lambda column: column in required_columns,
+            dtype={TIME_COLUMN: str, RESULTS_COLUMN: 'float32', amount_column: 'float32'}
+        )
+    fieldnames = list(df.columns)
+    app.logger.debug("Fieldnames: %s", fieldnames)  # Log the fieldnames for debugging
+
+    # Ensure consistency in column names and check required columns
+    missing_columns = [column for column in required_columns if column not in fieldnames]
+    if missing_columns:
+        raise ValueError(f"Missing required columns: {missing_columns}")
+
+    if df.empty:
+        raise ValueError("The file has no data rows.")
+
+    # Sum straight into 24-element arrays indexed by hour, without writing
+    # the hour or the filled columns back into the frame. Hours without any
+    # rows count as zero spend and zero results.
+    hours = df[TIME_COLUMN].str[:2].astype(np.int8).to_numpy()
+    if ((hours < 0) | (hours > 23)).any():
+        raise ValueError(f"Hours in '{TIME_COLUMN}' must be between 00 and 23.")
+    hourly_spent = np.bincount(hours, weights=df[amount_column].fillna(0).to_numpy(), minlength=24)
+    hourly_results = np.bincount(hours, weights=df[RESULTS_COLUMN].fillna(0).to_numpy(), minlength=24)
+
+    return hourly_spent, hourly_results
+
+class Recommendation(NamedTuple):
+    message: str
+    style: str
+    window_size: int
+    worst_consecutive_hours: list
+    current_avg_cost: float
+    avg_cost_worst_hours: float
+    avg_cost_remaining_hours: float
+    improvement_percentage: float
+    p_value: float
+
+def recommend(results):
+    # Pick the most improving significant window, or the one closest to significance
+    significant = results['p_value'] < SIGNIFICANCE_LEVEL
+
+    if significant.any():
+        best = results[np.where(significant, results['improvement_percentage'], -np.inf).argmax()]
+        message = "Best Window Size for Improvement (with p-value < 0.05):"
+        style = "success"
+    else:
+        best = results[np.nan_to_num(np.abs(results['p_value'] - SIGNIFICANCE_LEVEL), nan=np.inf).argmin()]
+        message = "No window size has a p-value < 0.05<br> Showing the closest result:"
+        style = "warning"
+
+    window_size = int(best['window_size'])
+    worst_start = int(best['worst_start'])
+    return Recommendation(
+        message=message,
+        style=style,
+        window_size=window_size,
+        worst_consecutive_hours=[(worst_start + hour) % 24 for hour in range(window_size)] if worst_start >= 0 else [],
+        current_avg_cost=best['current_avg_cost'],
+        avg_cost_worst_hours=best['avg_cost_worst_hours'],
+        avg_cost_remaining_hours=best['avg_cost_remaining_hours'],
+        improvement_percentage=best['improvement_percentage'],
+        p_value=best['p_value']
+    )
+
+def cache_get(key):
+    with hourly_totals_cache_lock:
+        if key not in hourly_totals_cache:
+            return None
+        hourly_totals_cache.move_to_end(key)
+        return hourly_totals_cache[key]
+
+def cache_put(key, value):
+    with hourly_totals_cache_lock:
+        hourly_totals_cache[key] = value
+        if len(hourly_totals_cache) > HOURLY_TOTALS_CACHE_SIZE:
+            hourly_totals_cache.popitem(last=False)
+
+def format_hourly(hourly):
+    # Round-trippable text for the hidden fields /reanalyze reads the totals back from
+    return ','.join(repr(value) for value in hourly.tolist())
+
+def parse_hourly(value):
+    hourly = np.array([float(item) for item in value.split(',')])
+    if hourly.shape != (24,) or not np.isfinite(hourly).all() or (hourly < 0).any():
+        raise ValueError("Expected 24 non-negative hourly totals.")
+    return hourly
+
+def render_result(currency, hourly_totals, min_window_size, max_window_size):
+    # The search runs before rendering so its errors reach the callers' error pages
+    hourly_spent, hourly_results = hourly_totals
+    recommendation = recommend(search_windows(hourly_spent, hourly_results, min_window_size, max_window_size))
+    return render_template(
+        'result.html', recommendation=recommendation,
+        currency=currency, hourly_spent=format_hourly(hourly_spent), hourly_results=format_hourly(hourly_results),
+        min_window_size=min_window_size, max_window_size=max_window_size,
+        window_size_limits=(MIN_WINDOW_SIZE, MAX_WINDOW_SIZE)
+    )
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -18,125 +264,45 @@ def analyze():
     file = request.files['file']
     
     try:
-        # Ensure the file is read in text mode
-        data = []
-        stream = file.stream.read().decode("utf-8").splitlines()
-        reader = csv.DictReader(stream)
-        fieldnames = reader.fieldnames
-        app.logger.debug(f"Fieldnames: {fieldnames}")  # Log the fieldnames for debugging
-        
-        for row in reader:
-            app.logger.debug(f"Row: {row}")  # Log each row for debugging
-            data.append(row)
-        
-        # Ensure consistency in column names and check required columns
-        required_columns = ['Results', 'Time of day (ad account time zone)', f'Amount spent ({currency})']
-        if not all(column in fieldnames for column in required_columns):
-            raise ValueError(f"<br>Missing required columns. Found columns: {fieldnames}<br>")
-        
-        # Process data
-        hourly_data = {}
-        for row in data:
-            hour = int(row['Time of day (ad account time zone)'][:2])
-            results = float(row['Results']) if row['Results'] else 0
-            amount_spent = float(row[f'Amount spent ({currency})']) if row[f'Amount spent ({currency})'] else 0
-            
-            if hour not in hourly_data:
-                hourly_data[hour] = {'Results': 0, 'Amount spent': 0}
-            hourly_data[hour]['Results'] += results
-            hourly_data[hour]['Amount spent'] += amount_spent
-
-        # Calculate cost per result
-        for hour in hourly_data:
-            if hourly_data[hour]['Results'] == 0:
-                hourly_data[hour]['Cost per Result'] = 0
-            else:
-                hourly_data[hour]['Cost per Result'] = hourly_data[hour]['Amount spent'] / hourly_data[hour]['Results']
-
-        # Calculate current average cost per result
-        total_results = sum(hourly_data[hour]['Results'] for hour in hourly_data)
-        total_cost = sum(hourly_data[hour]['Amount spent'] for hour in hourly_data)
-        current_avg_cost = total_cost / total_results if total_results != 0 else 0
-
-        # Function to find the worst consecutive hours for a given window size
-        def find_worst_hours(window_size):
-            worst_consecutive_hours = []
-            worst_avg_cost = 0
-
-            for start_hour in range(24):
-                hours_block = [(start_hour + i) % 24 for i in range(window_size)]
-                total_cost_worst_hours = sum(hourly_data[hour]['Amount spent'] for hour in hours_block)
-                total_results_worst_hours = sum(hourly_data[hour]['Results'] for hour in hours_block)
-                avg_cost_worst_hours = (total_cost_worst_hours / total_results_worst_hours) if total_results_worst_hours != 0 else 0
-
-                if avg_cost_worst_hours > worst_avg_cost:
-                    worst_avg_cost = avg_cost_worst_hours
-                    worst_consecutive_hours = hours_block
-
-            total_cost_worst_hours = sum(hourly_data[hour]['Amount spent'] for hour in worst_consecutive_hours)
-            total_results_worst_hours = sum(hourly_data[hour]['Results'] for hour in worst_consecutive_hours)
-            avg_cost_worst_hours = (total_cost_worst_hours / total_results_worst_hours) if total_results_worst_hours != 0 else 0
-
-            remaining_hours = [hour for hour in hourly_data if hour not in worst_consecutive_hours]
-            total_cost_remaining_hours = sum(hourly_data[hour]['Amount spent'] for hour in remaining_hours)
-            total_results_remaining_hours = sum(hourly_data[hour]['Results'] for hour in remaining_hours)
-            avg_cost_remaining_hours = (total_cost_remaining_hours / total_results_remaining_hours) if total_results_remaining_hours != 0 else 0
-
-            improvement_percentage = ((current_avg_cost - avg_cost_remaining_hours) / current_avg_cost) * 100 if current_avg_cost != 0 else 0
-            t_stat, p_value = ttest_ind(
-                [hourly_data[hour]['Cost per Result'] for hour in remaining_hours],
-                [hourly_data[hour]['Cost per Result'] for hour in worst_consecutive_hours]
-            )
-
-            return {
-                'window_size': window_size,
-                'worst_consecutive_hours': worst_consecutive_hours,
-                'current_avg_cost': round(current_avg_cost, 2),
-                'avg_cost_worst_hours': round(avg_cost_worst_hours, 2),
-                'avg_cost_remaining_hours': round(avg_cost_remaining_hours, 2),
-                'improvement_percentage': round(improvement_percentage, 2),
-                'p_value': round(p_value, 4)
-            }
-
-        results = []
-        for window_size in range(3, 13):
-            result = find_worst_hours(window_size)
-            results.append(result)
-
-        significant_results = [res for res in results if res['p_value'] < 0.05]
-
-        if significant_results:
-            best_significant_result = max(significant_results, key=lambda x: x['improvement_percentage'])
-            recommendation = {
-                'message': "Best Window Size for Improvement (with p-value < 0.05):",
-                'window_size': best_significant_result['window_size'],
-                'worst_consecutive_hours': best_significant_result['worst_consecutive_hours'],
-                'current_avg_cost': best_significant_result['current_avg_cost'],
-                'avg_cost_worst_hours': best_significant_result['avg_cost_worst_hours'],
-                'avg_cost_remaining_hours': best_significant_result['avg_cost_remaining_hours'],
-                'improvement_percentage': best_significant_result['improvement_percentage'],
-                'p_value': best_significant_result['p_value'],
-                'style': "success"
-            }
-        else:
-            closest_result = min(results, key=lambda x: abs(x['p_value'] - 0.05))
-            recommendation = {
-                'message': "No window size has a p-value < 0.05<br> Showing the closest result:",
-                'window_size': closest_result['window_size'],
-                'worst_consecutive_hours': closest_result['worst_consecutive_hours'],
-                'current_avg_cost': closest_result['current_avg_cost'],
-                'avg_cost_worst_hours': closest_result['avg_cost_worst_hours'],
-                'avg_cost_remaining_hours': closest_result['avg_cost_remaining_hours'],
-                'improvement_percentage': closest_result['improvement_percentage'],
-                'p_value': closest_result['p_value'],
-                'style': "warning"
-            }
-
-        return render_template('result.html', recommendation=recommendation, currency=currency)
-
-    except (ValueError, KeyError, csv.Error) as e:
-        app.logger.error(f"Error: {str(e)}")
-        error_message = f"<span style='color:var(--light-danger)'>Sorry - the file contents are wrong.</span><br>{str(e)}<br>Your file must have the following columns:<br><ul><li>Results</li><li>Time of day (ad account time zone)</li><li>Amount spent (XXX)</li></ul>Where XXX must match the selected currency."
+        # Identical uploads (refreshes, retries) skip parsing; hash the upload in
+        # chunks, then rewind it for the parser
+        digest = blake2b(digest_size=16)
+        for chunk in iter(lambda: file.stream.read(UPLOAD_HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+        file.stream.seek(0)
+        upload_hash = digest.hexdigest()
+        hourly_totals = cache_get((upload_hash, currency))
+        if hourly_totals is None:
+            hourly_totals = load_hourly_totals(file.stream, currency)
+            cache_put((upload_hash, currency), hourly_totals)
+
+        return render_result(currency, hourly_totals, DEFAULT_MIN_WINDOW_SIZE, DEFAULT_MAX_WINDOW_SIZE)
+
+    except (ValueError, KeyError) as e:
+        app.logger.error("Error: %s", e)
+        # The message can echo the currency field and cell values, so escape it
+        error_message = f"<span style='color:var(--light-danger)'>Sorry - the file contents are wrong.</span><br>{escape(str(e))}<br>Your file must have the following columns:<br><ul><li>Results</li><li>Time of day (ad account time zone)</li><li>Amount spent (XXX)</li></ul>Where XXX must match the selected currency."
+        return render_template('index.html', error_message=error_message)
+
+@app.route('/reanalyze', methods=['POST'])
+def reanalyze():
+    # Rerun the window search on the hourly totals the result page posts back, so
+    # this works on any instance without the upload or a server-side cache
+    try:
+        currency = request.form['currency']
+        hourly_totals = parse_hourly(request.form['hourly_spent']), parse_hourly(request.form['hourly_results'])
+
+        # Clamp the requested range to the precomputed windows
+        min_window_size = request.form.get('min_window_size', type=int, default=DEFAULT_MIN_WINDOW_SIZE)
+        max_window_size = request.form.get('max_window_size', type=int, default=DEFAULT_MAX_WINDOW_SIZE)
+        min_window_size = min(max(min_window_size, MIN_WINDOW_SIZE), MAX_WINDOW_SIZE)
+        max_window_size = min(max(max_window_size, min_window_size), MAX_WINDOW_SIZE)
+
+        return render_result(currency, hourly_totals, min_window_size, max_window_size)
+
+    except (ValueError, KeyError) as e:
+        app.logger.error("Error: %s", e)
+        error_message = "<span style='color:var(--light-danger)'>Sorry - this analysis could not be loaded.</span><br>Please upload your file again."
         return render_template('index.html', error_message=error_message)
 
 if __name__ == '__main__':
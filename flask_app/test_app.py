@@ -0,0 +1,166 @@
+import io
+
+import numpy as np
+import pytest
+from scipy.stats import ttest_ind
+
+import app
+from app import MAX_WINDOW_SIZE, MIN_WINDOW_SIZE, WINDOW_MASKS, load_hourly_totals, search_windows, ttest_pvalues
+
+HEADER = b'Campaign name,Results,Time of day (ad account time zone),Amount spent (NOK)\n'
+
+
+@pytest.fixture(params=['pyarrow', 'pandas'])
+def parser(request, monkeypatch):
+    # Run load_hourly_totals through both CSV parsers
+    if request.param == 'pyarrow':
+        if app.pyarrow_csv is None:
+            pytest.skip('pyarrow is not installed')
+    else:
+        monkeypatch.setattr(app, 'pyarrow_csv', None)
+    return request.param
+
+
+def test_load_hourly_totals(parser):
+    upload = HEADER + b'"Ad\nname",4,05:00:00 - 05:59:59,3.5\nOther,,05:00:00 - 05:59:59,2\nOther,1,23:00:00 - 23:59:59,\n'
+
+    hourly_spent, hourly_results = load_hourly_totals(io.BytesIO(upload), 'NOK')
+
+    assert hourly_spent.shape == hourly_results.shape == (24,)
+    assert hourly_spent[5] == pytest.approx(5.5)
+    assert hourly_results[5] == 4
+    assert hourly_results[23] == 1
+    assert hourly_spent.sum() == pytest.approx(5.5)
+
+
+@pytest.mark.parametrize('upload, message', [
+    (b'Results,Time of day (ad account time zone),Amount spent (EUR)\n1,01:00,2\n', 'Missing required columns'),
+    (HEADER, 'no data rows'),
+    (HEADER + b'a,1,24:00:00 - 24:59:59,2\n', 'between 00 and 23'),
+    (HEADER + b'a,1,,2\nb,3,,4\n', None),
+    (HEADER + b'a,abc,01:00:00 - 01:59:59,2\n', None),
+])
+def test_load_hourly_totals_rejects_bad_uploads(parser, upload, message):
+    with pytest.raises(ValueError, match=message):
+        load_hourly_totals(io.BytesIO(upload), 'NOK')
+
+
+def baseline_find_worst_hours(hourly_spent, hourly_results, window_size):
+    # The original per-window loop from analyze(), kept as the reference for search_windows
+    hourly_data = {
+        hour: {'Results': hourly_results[hour], 'Amount spent': hourly_spent[hour]}
+        for hour in range(24)
+    }
+    for hour in hourly_data:
+        if hourly_data[hour]['Results'] == 0:
+            hourly_data[hour]['Cost per Result'] = 0
+        else:
+            hourly_data[hour]['Cost per Result'] = hourly_data[hour]['Amount spent'] / hourly_data[hour]['Results']
+
+    total_results = sum(hourly_data[hour]['Results'] for hour in hourly_data)
+    total_cost = sum(hourly_data[hour]['Amount spent'] for hour in hourly_data)
+    current_avg_cost = total_cost / total_results if total_results != 0 else 0
+
+    worst_consecutive_hours = []
+    worst_avg_cost = 0
+    for start_hour in range(24):
+        hours_block = [(start_hour + i) % 24 for i in range(window_size)]
+        total_cost_worst_hours = sum(hourly_data[hour]['Amount spent'] for hour in hours_block)
+        total_results_worst_hours = sum(hourly_data[hour]['Results'] for hour in hours_block)
+        avg_cost_worst_hours = (total_cost_worst_hours / total_results_worst_hours) if total_results_worst_hours != 0 else 0
+        if avg_cost_worst_hours > worst_avg_cost:
+            worst_avg_cost = avg_cost_worst_hours
+            worst_consecutive_hours = hours_block
+
+    total_cost_worst_hours = sum(hourly_data[hour]['Amount spent'] for hour in worst_consecutive_hours)
+    total_results_worst_hours = sum(hourly_data[hour]['Results'] for hour in worst_consecutive_hours)
+    avg_cost_worst_hours = (total_cost_worst_hours / total_results_worst_hours) if total_results_worst_hours != 0 else 0
+
+    remaining_hours = [hour for hour in hourly_data if hour not in worst_consecutive_hours]
+    total_cost_remaining_hours = sum(hourly_data[hour]['Amount spent'] for hour in remaining_hours)
+    total_results_remaining_hours = sum(hourly_data[hour]['Results'] for hour in remaining_hours)
+    avg_cost_remaining_hours = (total_cost_remaining_hours / total_results_remaining_hours) if total_results_remaining_hours != 0 else 0
+
+    improvement_percentage = ((current_avg_cost - avg_cost_remaining_hours) / current_avg_cost) * 100 if current_avg_cost != 0 else 0
+    t_stat, p_value = ttest_ind(
+        [hourly_data[hour]['Cost per Result'] for hour in remaining_hours],
+        [hourly_data[hour]['Cost per Result'] for hour in worst_consecutive_hours]
+    )
+
+    return {
+        'worst_consecutive_hours': worst_consecutive_hours,
+        'current_avg_cost': round(current_avg_cost, 2),
+        'avg_cost_worst_hours': round(avg_cost_worst_hours, 2),
+        'avg_cost_remaining_hours': round(avg_cost_remaining_hours, 2),
+        'improvement_percentage': round(improvement_percentage, 2),
+        'p_value': round(p_value, 4)
+    }
+
+
+def random_hourly_totals(seed):
+    rng = np.random.default_rng(seed)
+    hourly_spent = np.round(rng.uniform(0, 500, 24), 2)
+    hourly_results = rng.integers(0, 40, 24).astype(np.float64)
+    # Some hours with spend but no results
+    hourly_results[rng.choice(24, size=4, replace=False)] = 0
+    return hourly_spent, hourly_results
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_ttest_pvalues_matches_scipy(seed):
+    hourly_spent, hourly_results = random_hourly_totals(seed)
+    cost_per_result = np.divide(hourly_spent, hourly_results, out=np.zeros(24), where=hourly_results != 0)
+    masks = WINDOW_MASKS.reshape(-1, 24)
+
+    expected = [ttest_ind(cost_per_result[~mask], cost_per_result[mask]).pvalue for mask in masks]
+
+    assert ttest_pvalues(cost_per_result, masks) == pytest.approx(expected, rel=1e-9, abs=1e-15)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_search_windows_matches_baseline(seed):
+    hourly_spent, hourly_results = random_hourly_totals(seed)
+
+    results = search_windows(hourly_spent, hourly_results, MIN_WINDOW_SIZE, MAX_WINDOW_SIZE)
+
+    assert results['window_size'].tolist() == list(range(MIN_WINDOW_SIZE, MAX_WINDOW_SIZE + 1))
+    for result in results:
+        window_size = int(result['window_size'])
+        expected = baseline_find_worst_hours(hourly_spent, hourly_results, window_size)
+        worst_start = int(result['worst_start'])
+        assert [(worst_start + hour) % 24 for hour in range(window_size)] == expected['worst_consecutive_hours']
+        # Totals are summed in a different order, so a value sitting exactly on a rounding
+        # boundary may land one unit away in the last displayed digit
+        for field, unit in (('current_avg_cost', 0.01), ('avg_cost_worst_hours', 0.01),
+                            ('avg_cost_remaining_hours', 0.01), ('improvement_percentage', 0.01),
+                            ('p_value', 0.0001)):
+            assert result[field] == pytest.approx(expected[field], abs=unit * 1.001), (window_size, field)
+
+
+def test_reanalyze_uses_posted_totals_without_cache():
+    client = app.app.test_client()
+    upload = HEADER + b''.join(
+        b'a,%d,%02d:00:00 - %02d:59:59,%d\n' % (1 + hour % 5, hour, hour, 10 + hour * 3) for hour in range(24)
+    )
+    page = client.post('/analyze', data={'currency': 'NOK', 'file': (io.BytesIO(upload), 'export.csv')}).get_data(as_text=True)
+    hourly_fields = {
+        name: page.split(f'name="{name}" value="', 1)[1].split('"', 1)[0]
+        for name in ('hourly_spent', 'hourly_results')
+    }
+    app.hourly_totals_cache.clear()
+
+    page = client.post('/reanalyze', data={
+        'currency': 'NOK', 'min_window_size': 4, 'max_window_size': 4, **hourly_fields
+    }).get_data(as_text=True)
+
+    assert 'Window Size: 4 hours' in page
+
+
+def test_reanalyze_rejects_tampered_totals():
+    client = app.app.test_client()
+
+    page = client.post('/reanalyze', data={
+        'currency': 'NOK', 'hourly_spent': '1,2,3', 'hourly_results': ','.join(['1.0'] * 24)
+    }).get_data(as_text=True)
+
+    assert 'could not be loaded' in page